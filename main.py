@@ -24,22 +24,118 @@ in using the service.
 
 import base64
 import datetime
+import functools
 import json
 import logging
+import operator
 import os
-import slack
-from google.cloud import secretmanager
+import re
+import threading
+import time
 from mysecret import MySecret
 
+LOGGER = logging.getLogger(__name__)
+
 # General references:
 # * https://api.slack.com/docs/token-types#bot
-# * https://github.com/slackapi/python-slackclient
+# * https://github.com/slackapi/python-slack-sdk
 # * https://github.com/GoogleCloudPlatform/python-docs-samples/blob/master/functions/billing/main.py
 
 # Keep resources in global scope that we want to persist across warm starts of the function.
 # See https://cloud.google.com/functions/docs/concepts/exec#cold_starts
-SECRET_CLIENT = secretmanager.SecretManagerServiceClient()
-SLACK_CLIENT = None
+SECRET_CLIENT = None
+
+# One secret per project holds both the Slack token and the per-budget alert
+# states, so a cold start needs only a single access_secret_version call.
+CONFIG_SECRET_NAME = "gcp-slack-notifier-config"
+
+# config MySecret objects cached by project_id so the Secret Manager
+# roundtrip happens at most once per warm container.
+_SECRET_CACHE = {}
+
+# when we last posted to each Slack channel, for client-side rate limiting
+_LAST_POST = {}
+
+# Pub/Sub resource names look like "projects/<project>/topics/<topic>"
+_RESOURCE_RE = re.compile(r"^projects/(?P<project_id>[^/]+)/topics/(?P<topic_id>[^/]+)$")
+
+# everything we need out of the alert data, pulled in one C-level call
+_ALERT_FIELDS = operator.itemgetter(
+    "budgetDisplayName",
+    "costAmount",
+    "budgetAmount",
+    "currencyCode",
+    "costIntervalStart",
+    "alertThresholdExceeded",
+)
+
+
+def _get_secret_client():
+    """Build the Secret Manager client on first use and reuse it afterward.
+
+    Importing google.cloud.secretmanager drags in gRPC and protobuf, which
+    dominate Python cold-start time, so don't pay for it until an event
+    actually needs the client.
+    """
+
+    # pylint: disable=global-statement
+    global SECRET_CLIENT
+    if SECRET_CLIENT is None:
+        from google.cloud import secretmanager  # pylint: disable=import-outside-toplevel
+
+        SECRET_CLIENT = secretmanager.SecretManagerServiceClient()
+    return SECRET_CLIENT
+
+
+def _warm_clients():
+    """Prime everything the first event would otherwise pay for.
+
+    The first RPC on a fresh Secret Manager client pays for gRPC channel
+    setup, the TLS handshake, and an auth token fetch, which can add seconds
+    to a cold start. Calling _slack_client() covers all of that: it fetches
+    the config secret (priming the channel, the token, and the config cache)
+    and then connects to Slack.
+    """
+
+    project_id = os.environ.get("GCP_PROJECT")
+    if not project_id:
+        return
+    try:
+        # fetching the config secret primes the gRPC channel, the auth token,
+        # and the config cache in one shot; the Slack connect rides on it
+        _slack_client(project_id)
+    except Exception as err:  # pylint: disable=broad-except
+        # warming up is best-effort; the event path will retry for real
+        LOGGER.debug("client warmup failed: %s", err)
+
+
+def _get_config_secret(project_id):
+    """Return the project's config secret, cached for the container lifetime."""
+
+    secret = _SECRET_CACHE.get(project_id)
+    if not secret:
+        secret = _SECRET_CACHE.setdefault(
+            project_id,
+            MySecret(
+                project_id, name=CONFIG_SECRET_NAME, secret_client=_get_secret_client()
+            ),
+        )
+    return secret
+
+
+@functools.lru_cache(maxsize=1)
+def _slack_client(project_id):
+    """Connect to Slack once per container and reuse the client afterward."""
+
+    config = _get_config_secret(project_id).data or {}
+    return slack_connect(
+        project_id, _get_secret_client(), token=config.get("slack_token")
+    )
+
+
+# kick off client setup in the background so it overlaps with the rest of
+# module initialization and is (usually) done before the first event lands
+threading.Thread(target=_warm_clients, daemon=True).start()
 
 
 # pylint: disable=too-many-locals
@@ -56,61 +152,77 @@ def notify_slack(payload, context):
         https://cloud.google.com/functions/docs/writing/background#function_parameters
     """
 
-    # pylint: disable=global-statement
-    # we're taking advantage of Google Cloud Function cold/warm starts
-    global SLACK_CLIENT
-
     # payload metadata comes in `attributes`, actual event message comes in `data`
     alert_attrs = payload.get("attributes")
-    alert_data = json.loads(base64.b64decode(payload.get("data")).decode("utf-8"))
-    logging.info(
-        "new billing alert; context=%s, attributes=%s, data=%s",
-        context,
-        alert_attrs,
-        alert_data,
-    )
+    # json.loads takes bytes directly, so no need for an intermediate decode
+    alert_data = json.loads(base64.b64decode(payload["data"]))
+    # repr-ing the whole event is only worth it if the line will be emitted
+    if LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info(
+            "new billing alert; context=%s, attributes=%s, data=%s",
+            context,
+            alert_attrs,
+            alert_data,
+        )
 
     # parse the GCP resource name to extract information about where we're running
-    resource_name = context.resource.get("name").split("/")
-    if resource_name[0] == "projects":
-        project_id = resource_name[1]
+    resource_match = _RESOURCE_RE.match(context.resource.get("name", ""))
+    if resource_match:
+        project_id = resource_match["project_id"]
+        topic_id = resource_match["topic_id"]
     else:
         project_id = "UNKNOWN"
-    if resource_name[2] == "topics":
-        topic_id = resource_name[3]
-    else:
         topic_id = "UNKNOWN"
-    logging.debug(
+    LOGGER.debug(
         "extracted resource info from context: project_id=%s, topic_id=%s",
         project_id,
         topic_id,
     )
 
-    # we (re)store state info in a Google Cloud Secret because it's already
-    # being used for our Slack token
+    # state info lives in the same Google Cloud Secret as our Slack token,
+    # keyed by which budget alert we're handling
     billing_id = alert_attrs.get("billingAccountId")
     budget_id = alert_attrs.get("budgetId")
-    secret = MySecret(
-        project_id,
-        context={
-            "billing_id": billing_id,
-            "budget_id": budget_id,
-            "topic_id": topic_id,
-        },
-        secret_client=SECRET_CLIENT,
-    )
-    alert_state = restore_state(secret)
-
-    # extract relevant info from the alert data for our Slack message
-    budget_name = alert_data.get("budgetDisplayName")
-    cost = "${:,.2f}".format(float(alert_data.get("costAmount")))
-    budget = "${:,.2f}".format(float(alert_data.get("budgetAmount")))
-    currency = alert_data.get("currencyCode")
-    interval = datetime.datetime.strptime(
-        alert_data.get("costIntervalStart"), "%Y-%m-%dT%H:%M:%S%z"
-    )
+    secret = _get_config_secret(project_id)
+    state_key = f"{billing_id}_{budget_id}_{topic_id}"
+
+    (
+        budget_name,
+        cost_raw,
+        budget_raw,
+        currency,
+        interval_raw,
+        threshold_raw,
+    ) = _ALERT_FIELDS(alert_data)
+
+    # the throttle decision only needs the interval and threshold, so don't
+    # format anything else until we know we're actually going to post.
+    # costIntervalStart is ISO-8601; fromisoformat is much faster than
+    # strptime, but before Python 3.11 it can't take a trailing "Z"
+    interval = datetime.datetime.fromisoformat(interval_raw.replace("Z", "+00:00"))
+    threshold = float(threshold_raw) * 100
+
+    # Unlike email alerts, Google Cloud Billing's _programmatic_ alerts repeat
+    # as long as the alert is valid, so we need to self-throttle.
+    # This is the whole reason we need to keep state.
+    alert_state = restore_state(secret, state_key)
+
+    # only send an alert for the given context if we haven't already done so;
+    # repeats are the common case, so bail out as early as possible
+    last_interval = alert_state.get("last_interval", datetime.datetime.fromordinal(1))
+    last_threshold = alert_state.get("last_threshold", -1)
+    if interval == last_interval and threshold <= last_threshold:
+        LOGGER.info("%s/%s: ignoring repeat alert...", billing_id, budget_id)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(
+                "last_interval=%s, last_threshold=%s", last_interval, last_threshold
+            )
+        return
+
+    # format the rest of the alert data for our Slack message
+    cost = "${:,.2f}".format(float(cost_raw))
+    budget = "${:,.2f}".format(float(budget_raw))
     interval_str = interval.strftime("%b %d, %Y")
-    threshold = float(alert_data.get("alertThresholdExceeded")) * 100
 
     # Compose our Slack alert
     # https://api.slack.com/reference/surfaces/formatting#basics
@@ -122,14 +234,9 @@ def notify_slack(payload, context):
     if threshold > 100:
         slack_msg += ":sad: https://media.giphy.com/media/l0HFkA6omUyjVYqw8/giphy.gif"
 
-    # Unlike email alerts, Google Cloud Billing's _programmatic_ alerts repeat
-    # as long as the alert is valid, so we need to self-throttle.
-    # This is the whole reason we need to keep state.
-
     # if we're dealing with a new interval, reset our state
-    last_interval = alert_state.get("last_interval", datetime.datetime.fromordinal(1))
     if interval != last_interval:
-        logging.debug(
+        LOGGER.debug(
             "%s/%s: last interval @ %s != new @ %s: resetting alert state",
             billing_id,
             budget_id,
@@ -137,100 +244,108 @@ def notify_slack(payload, context):
             interval,
         )
         alert_state["last_interval"] = interval
-        alert_state["last_threshold"] = -1
 
-    # only send an alert for the given context if we haven't already done so
-    last_threshold = alert_state.get("last_threshold", -1)
-    if threshold <= last_threshold:
-        logging.info("%s/%s: ignoring repeat alert...", billing_id, budget_id)
-        logging.debug(
-            "last_interval=%s, last_threshold=%s, msg=%s",
-            last_interval,
-            last_threshold,
-            slack_msg,
-        )
-        return
-    logging.info(
+    LOGGER.info(
         "%s/%s: alert came for new threshold: %s", billing_id, budget_id, threshold
     )
     alert_state["last_threshold"] = threshold
 
-    save_state(secret, alert_state)
+    save_state(secret, state_key, alert_state)
 
     # finally, send our message to Slack
-    logging.info(
+    LOGGER.info(
         "last_interval=%s, last_threshold=%s, msg=%s",
         last_interval,
         last_threshold,
         slack_msg,
     )
-    if not SLACK_CLIENT:
-        SLACK_CLIENT = slack_connect(project_id, SECRET_CLIENT)
-
     channel = os.environ.get("SLACK_CHANNEL", "#gcp-test")
-    slack_post(SLACK_CLIENT, channel, slack_msg)
+    slack_post(_slack_client(project_id), channel, slack_msg)
 
 
-def restore_state(secret):
-    """Restore our alert state from a Secret.
+def restore_state(secret, state_key):
+    """Restore one budget alert's state from the config Secret.
 
     Args:
-        secret (MySecret object): has data with secret info and manages access
-                                  to Google Cloud Secret Manager
+        secret (MySecret object): config secret holding the "states" dict;
+                                  manages access to Google Cloud Secret Manager
+        state_key (str): which budget alert's state to pull out
 
     Returns:
-        dict with state info
+        dict with state info, "last_interval" restored to a datetime
     """
 
-    logging.debug("restoring state from secret")
-    if secret.data:
-        state = secret.data
-    else:
-        state = dict()
+    LOGGER.debug("restoring state from secret")
+    config = secret.data or {}
+    state = dict(config.get("states", {}).get(state_key, {}))
+    if "last_interval" in state:
+        state["last_interval"] = datetime.datetime.fromisoformat(
+            state["last_interval"]
+        )
     return state
 
 
-def save_state(secret, state):
-    """Save our alert state in a Secret so we can pull it again the next time we run."""
+def save_state(secret, state_key, state):
+    """Save one budget alert's state in the config Secret for the next run.
+
+    The write happens in the background so the Slack post isn't stuck
+    behind the add_secret_version RPC; the in-memory copy is current
+    immediately.
+    """
 
-    secret.data = state
+    state = dict(state)
+    if isinstance(state.get("last_interval"), datetime.datetime):
+        state["last_interval"] = state["last_interval"].isoformat()
+    config = secret.data or {}
+    config.setdefault("states", {})[state_key] = state
+    secret.save_async(config)
 
 
-def slack_connect(project_id, secret_client):
+def slack_connect(project_id, secret_client, token=None):
     """Connect to Slack and return a client.
 
     Args:
         project_id (str): GCP project identifier
+        secret_client (obj): active google.cloud.secretmanager client
+        token (str): Slack API token, if the caller already has one
+                     (e.g. from the config secret)
 
     Returns:
         slack client object
     """
 
+    # deferred so the slack_sdk package isn't loaded at cold start
+    # pylint: disable=import-outside-toplevel
+    from slack_sdk import WebClient
+    from slack_sdk.errors import SlackApiError
+
     client = None
 
-    # Try reading a token from the environment first
-    token = os.environ.get("SLACK_API_TOKEN", None)
+    # A token from the environment wins over one passed in
+    token = os.environ.get("SLACK_API_TOKEN", None) or token
 
-    # If that didn't work, get it from Google Secret Manager
+    # If we still have nothing, fall back to the legacy standalone secret
     if not token:
         secret_name = "gcp-slack-notifier-SLACK_API_TOKEN"
         secret_path = secret_client.secret_version_path(
             project_id, secret_name, "latest"
         )
-        secret_version = secret_client.access_secret_version(secret_path)
+        secret_version = secret_client.access_secret_version(
+            request={"name": secret_path}
+        )
         token = secret_version.payload.data.decode("utf-8").strip()
 
     if not token:
-        logging.error("no Slack API token available, aborting")
+        LOGGER.error("no Slack API token available, aborting")
         return None
 
     try:
         # log the token type (the 1st 4 chars) and the very end -- not enough to steal it,
         # but enough to identify which token is in use when debugging access & scopes
-        logging.debug("connecting to slack; token=%s...%s", token[:4], token[-4:])
-        client = slack.WebClient(token=token)
-    except slack.errors.SlackApiError as err:
-        logging.error(err)
+        LOGGER.debug("connecting to slack; token=%s...%s", token[:4], token[-4:])
+        client = WebClient(token=token)
+    except SlackApiError as err:
+        LOGGER.error(err)
     return client
 
 
@@ -247,7 +362,7 @@ def slack_post(client, channel, msg):
     See https://api.slack.com/authentication/token-types#bot for more.
 
     Args:
-        client (slack.WebClient): previously-connected Slack web client
+        client (slack_sdk.WebClient): previously-connected Slack web client
         channel (str):            location in Slack where message should be posted
         msg (str):                message to send
 
@@ -255,8 +370,30 @@ def slack_post(client, channel, msg):
         None
     """
 
+    from slack_sdk.errors import SlackApiError  # pylint: disable=import-outside-toplevel
+
+    # Slack allows roughly one message per second per channel, so pace
+    # ourselves instead of provoking a 429
+    # https://api.slack.com/docs/rate-limits
+    wait = 1 - (time.monotonic() - _LAST_POST.get(channel, 0))
+    if wait > 0:
+        time.sleep(wait)
+
     try:
-        logging.debug("posting to slack; msg=%d chars", len(msg))
+        LOGGER.debug("posting to slack; msg=%d chars", len(msg))
         client.chat_postMessage(channel=channel, text=msg)
-    except slack.errors.SlackApiError as err:
-        logging.error(err)
+    except SlackApiError as err:
+        if err.response.status_code != 429:
+            LOGGER.error(err)
+            return
+        # rate-limited anyway; honor Retry-After and try once more rather
+        # than silently dropping the alert
+        retry_after = int(err.response.headers.get("Retry-After", "1"))
+        LOGGER.warning("rate-limited by slack, retrying in %ds", retry_after)
+        time.sleep(retry_after)
+        try:
+            client.chat_postMessage(channel=channel, text=msg)
+        except SlackApiError as retry_err:
+            LOGGER.error(retry_err)
+    finally:
+        _LAST_POST[channel] = time.monotonic()
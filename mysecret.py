@@ -1,10 +1,13 @@
 """Provide a class to manage Google Cloud Secret Manager secrets
 """
 
+import json
 import logging
-import pickle
-import parse
-import google
+import os
+import threading
+from google.api_core.exceptions import NotFound
+
+LOGGER = logging.getLogger(__name__)
 
 # See: https://googleapis.dev/python/secretmanager/latest/gapic/v1/api.html
 class MySecret:
@@ -17,13 +20,25 @@ class MySecret:
         project_id: Google Cloud Platform project in which the secret is stored
         parent: first path of path to Secret Manager object, before the relative name
         relative_name: short name of Secret Manager object, after "projects/_ID_/secrets/"
+        secret_path: full resource path of the secret, "{parent}/secrets/{relative_name}"
     """
 
-    client = None
-    relative_name = None
-    parent = None
-    project_id = None
-    secret = None
+    # a warm container caches a MySecret per budget and hits these attributes
+    # on every throttle decision; slots keep the instances small and the
+    # lookups cheap
+    __slots__ = (
+        "client",
+        "relative_name",
+        "parent",
+        "project_id",
+        "secret",
+        "secret_path",
+        "_data",
+        "_data_fetched",
+        "_latest_version_name",
+        "_tmp_path",
+        "_tmp_cached",
+    )
 
     def __init__(self, project_id, name=None, context=None, secret_client=None):
         """Creates a new MySecret object and prepares it for use.
@@ -38,8 +53,9 @@ class MySecret:
             secret_client (obj): active google.cloud.secretmanager client
         """
         self._data = None
+        self._data_fetched = False
         self.client = secret_client
-        self.parent = secret_client.project_path(project_id)
+        self.parent = f"projects/{project_id}"
         self.project_id = project_id
         context = context or {}
         billing_id = context.get("billing_id", None)
@@ -57,19 +73,36 @@ class MySecret:
             if budget_id:
                 self.relative_name += f"_BUDGET-{budget_id}"
 
-        all_secrets = secret_client.list_secrets(self.parent)
-        for found_secret in all_secrets:
-            found_parts = parse.parse(
-                "projects/{self.project_id}/secrets/{relative_name}", found_secret.name
-            )
-            if found_parts.named["relative_name"] == self.relative_name:
-                logging.debug("found existing secret: %s", found_secret.name)
-                self.secret = found_secret
-                return
-
-        logging.info("creating new secret: %s/%s", self.parent, self.relative_name)
+        self.secret_path = f"{self.parent}/secrets/{self.relative_name}"
+        self._latest_version_name = f"{self.secret_path}/versions/latest"
+
+        # Cloud Functions' /tmp is a tmpfs that lives as long as the instance,
+        # so throttle state cached there can outlive a module reload in the
+        # same container. Only the "states" part is ever mirrored -- the
+        # Slack token stays in Secret Manager and off the filesystem
+        self._tmp_path = f"/tmp/{self.relative_name}.json"
+        self._tmp_cached = None
+        try:
+            with open(self._tmp_path, encoding="utf-8") as cached:
+                self._tmp_cached = json.load(cached)
+            LOGGER.debug("loaded cached state from %s", self._tmp_path)
+        except (OSError, ValueError):
+            pass
+
+        try:
+            self.secret = secret_client.get_secret(request={"name": self.secret_path})
+            LOGGER.debug("found existing secret: %s", self.secret.name)
+            return
+        except NotFound:
+            pass
+
+        LOGGER.info("creating new secret: %s/%s", self.parent, self.relative_name)
         self.secret = secret_client.create_secret(
-            self.parent, self.relative_name, {"replication": {"automatic": {},},}
+            request={
+                "parent": self.parent,
+                "secret_id": self.relative_name,
+                "secret": {"replication": {"automatic": {}}},
+            }
         )
 
     def __repr__(self):
@@ -83,23 +116,34 @@ class MySecret:
         If not, it pulls the latest from Google
 
         Returns:
-            None if unavailable, otherwise
-            Python data type as restored from Google Secret & unpickled
+            None if the secret has no versions yet, otherwise
+            dict as restored from the Google Secret's JSON payload
+
+        Raises:
+            google.api_core.exceptions.GoogleAPICallError: the read failed
+                for any reason other than the version not existing
         """
 
-        if not self._data:
+        if not self._data_fetched:
+            LOGGER.debug("refreshing latest data for %s", self.secret.name)
             try:
-                logging.debug("refreshing latest data for %s", self.secret.name)
                 secret_version = self.client.access_secret_version(
-                    self.secret.name + "/versions/latest"
-                )
-                self._data = pickle.loads(secret_version.payload.data)
-            except google.api_core.exceptions.GoogleAPICallError as err:
-                logging.warning(
-                    "error reading %s/versions/latest (may just not exist)",
-                    self.secret.name,
+                    request={"name": self._latest_version_name}
                 )
-                logging.warning(err)
+                self._data = json.loads(secret_version.payload.data)
+            except NotFound:
+                # the secret simply has no versions yet, so it's genuinely
+                # empty. Any other API error propagates -- mistaking, say, a
+                # timeout for an empty secret would let a later save rewrite
+                # the whole stored blob (Slack token included) from scratch
+                LOGGER.warning("no versions of %s yet", self.secret.name)
+            # throttle state mirrored to /tmp may be newer than the stored
+            # version (the mirror is written before the async write lands),
+            # so overlay it on whatever we fetched
+            if self._tmp_cached and self._tmp_cached.get("states"):
+                self._data = self._data or {}
+                self._data.setdefault("states", {}).update(self._tmp_cached["states"])
+            self._data_fetched = True
         return self._data
 
     @data.setter
@@ -107,14 +151,58 @@ class MySecret:
         """Create a new version of the Secret and update our cached copy.
 
         Args:
-            value: Converts the python data type to a pickled, binary object.
-        Returns:
-            new Secret version
+            value (dict): Serialized to JSON for storage.
         """
 
-        logging.debug("adding new version of %s: %s", self.secret.name, value)
-        version = self.client.add_secret_version(
-            self.secret.name, {"data": pickle.dumps(value)}
-        )
         self._data = value
-        return version
+        self._data_fetched = True
+        self._add_version(value)
+
+    def save_async(self, value):
+        """Update the cached copy now and write the Secret version in the background.
+
+        Callers that don't need to wait for the add_secret_version RPC (it's a
+        couple hundred ms) can use this to take the write off their critical
+        path. The in-memory copy is updated synchronously, so later reads in
+        this container see the new value either way; worst case, a crash
+        before the write lands costs us one stale version on the next cold
+        start.
+
+        Args:
+            value (dict): Serialized to JSON for storage.
+        """
+
+        self._data = value
+        self._data_fetched = True
+        threading.Thread(target=self._add_version, args=(value,), daemon=True).start()
+
+    def _add_version(self, value):
+        """Add a new version of the Secret holding the JSON-serialized value."""
+
+        # guard the repr of the whole payload behind the level check
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("adding new version of %s: %s", self.secret.name, value)
+        self._write_tmp_cache(value)
+        return self.client.add_secret_version(
+            request={
+                "parent": self.secret_path,
+                "payload": {"data": json.dumps(value).encode()},
+            }
+        )
+
+    def _write_tmp_cache(self, value):
+        """Mirror the throttle state to the /tmp cache, atomically via os.replace.
+
+        The Slack token is stripped first; only the "states" entries belong
+        on disk.
+        """
+
+        try:
+            cacheable = {key: val for key, val in value.items() if key != "slack_token"}
+            new_path = self._tmp_path + ".new"
+            with open(new_path, "w", encoding="utf-8") as cached:
+                json.dump(cacheable, cached)
+            os.replace(new_path, self._tmp_path)
+        except OSError as err:
+            # the cache is an optimization; losing it just means another RPC
+            LOGGER.warning("could not cache secret data to %s: %s", self._tmp_path, err)